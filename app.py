@@ -1,78 +1,177 @@
 #!/usr/bin/env python3
 import sqlite3
-import requests
 import hashlib
 import hmac
-from flask import Flask, render_template, jsonify, session, redirect, url_for, request
+import queue
+import atexit
+from flask import Flask, render_template, jsonify, session, redirect, url_for, request, g
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
 from datetime import datetime, timedelta
+from functools import lru_cache
 import pytz
 import secrets
 import os
+import fcntl
+import tempfile
+import time
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
-# Use persistent secret key from environment or generate one
+app.json = OrjsonProvider(app)
+# Use persistent secret key so sessions survive restarts
 SECRET_KEY_FILE = "/var/lib/light_status/dashboard_secret.key"
-if os.path.exists(SECRET_KEY_FILE):
-    with open(SECRET_KEY_FILE, 'r') as f:
-        app.secret_key = f.read().strip()
-else:
-    app.secret_key = secrets.token_hex(32)
-    os.makedirs(os.path.dirname(SECRET_KEY_FILE), exist_ok=True)
-    with open(SECRET_KEY_FILE, 'w') as f:
-        f.write(app.secret_key)
+
+def load_secret_key():
+    """Read the secret key file, creating it once if missing"""
+    if os.path.exists(SECRET_KEY_FILE):
+        with open(SECRET_KEY_FILE, 'r') as f:
+            return f.read().strip()
+    
+    key_dir = os.path.dirname(SECRET_KEY_FILE)
+    os.makedirs(key_dir, exist_ok=True)
+    # Lock so workers starting in parallel agree on a single key
+    with open(SECRET_KEY_FILE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(SECRET_KEY_FILE):
+            with open(SECRET_KEY_FILE, 'r') as f:
+                return f.read().strip()
+        
+        secret_key = secrets.token_hex(32)
+        # Write to a temp file (created 0600) and rename, so readers never see a partial key
+        with tempfile.NamedTemporaryFile('w', dir=key_dir, delete=False) as f:
+            f.write(secret_key)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, SECRET_KEY_FILE)
+        return secret_key
+
+app.secret_key = load_secret_key()
+
+# Short-lived cache for the dashboard's polling endpoints
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 
 DB_FILE = "/var/lib/light_status/config.db"
-BOT_API_URL = "http://localhost:8080"
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '')  # Set via environment variable
+# Key for verifying Telegram login data, derived once from the bot token
+TELEGRAM_SECRET_KEY = hashlib.sha256(BOT_TOKEN.encode()).digest() if BOT_TOKEN else None
+AUTH_MAX_AGE = 86400  # Seconds a Telegram login stays valid
 
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
+# Process-wide pool of SQLite connections, reused across requests and threads
+DB_POOL_SIZE = 8
+_POOL = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    # WAL lets dashboard reads run alongside the bot's writes
+    journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    if journal_mode != 'wal':
+        app.logger.warning("SQLite journal_mode is %s, expected wal", journal_mode)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")  # Read pages through a 256 MB memory map
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB page cache
     return conn
 
+def get_db():
+    """Get a pooled connection for the current request"""
+    if 'db' not in g:
+        try:
+            g.db = _POOL.get_nowait()
+        except queue.Empty:
+            g.db = _connect()
+    return g.db
+
+@app.teardown_request
+def release_db(exc):
+    """Return the request's connection to the pool"""
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    try:
+        _POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@atexit.register
+def close_pool():
+    while True:
+        try:
+            _POOL.get_nowait().close()
+        except queue.Empty:
+            break
+
+def init_db():
+    """Create the covering index used by the stats queries, once across workers"""
+    conn = sqlite3.connect(DB_FILE, timeout=10)
+    try:
+        if _has_history_index(conn):
+            return
+        # Lock so workers starting in parallel don't all try to build the index
+        with open(DB_FILE + '.dashboard.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if _has_history_index(conn):
+                return
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_chan_ts ON history(channel_id, timestamp, status)"
+            )
+            # Refresh planner statistics only when the index is new
+            conn.execute("ANALYZE history")
+            conn.commit()
+    except sqlite3.OperationalError as e:
+        # A busy or not yet initialized database must not stop the app from booting
+        app.logger.warning("Could not create history index: %s", e)
+    finally:
+        conn.close()
+
+def _has_history_index(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_history_chan_ts'"
+    ).fetchone() is not None
+
+if os.path.exists(DB_FILE):
+    init_db()
+
+@lru_cache(maxsize=128)
+def get_timezone(name):
+    """Build a timezone once per distinct name"""
+    return pytz.timezone(name)
+
 def verify_telegram_auth(auth_data):
     """Verify Telegram login widget data"""
     check_hash = auth_data.get('hash')
-    if not check_hash or not BOT_TOKEN:
+    if not check_hash or not TELEGRAM_SECRET_KEY:
+        return False
+    
+    # Reject stale or missing auth_date before doing any HMAC work
+    try:
+        auth_age = time.time() - int(auth_data.get('auth_date', ''))
+    except ValueError:
+        return False
+    if auth_age > AUTH_MAX_AGE:
         return False
     
-    auth_data_copy = {k: v for k, v in auth_data.items() if k != 'hash'}
-    data_check_string = '\n'.join([f"{k}={v}" for k, v in sorted(auth_data_copy.items())])
+    data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(auth_data.items()) if k != 'hash')
     
-    secret_key = hashlib.sha256(BOT_TOKEN.encode()).digest()
-    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    calculated_hash = hmac.new(TELEGRAM_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
     
-    return calculated_hash == check_hash
+    # Constant-time comparison; bytes so non-ASCII input can't raise TypeError
+    return hmac.compare_digest(calculated_hash.encode(), check_hash.encode())
 
 def check_auth():
     """Check if user is authenticated via Telegram"""
     return session.get('telegram_user_id') is not None
 
-def check_channel_access(user_id, channel_id):
-    """Check if user owns the channel or is whitelisted"""
-    conn = get_db()
-    channel = conn.execute(
-        "SELECT owner_id FROM channels WHERE channel_id = ?", (channel_id,)
-    ).fetchone()
-    
-    if not channel:
-        conn.close()
-        return False
-    
-    # Check if owner
-    if channel['owner_id'] == user_id:
-        conn.close()
-        return True
-    
-    # Check if whitelisted
-    whitelisted = conn.execute(
-        "SELECT 1 FROM whitelist WHERE channel_id = ? AND user_id = ?",
-        (channel_id, user_id)
-    ).fetchone()
-    conn.close()
-    
-    return whitelisted is not None
-
 @app.route('/')
 def index():
     if not check_auth():
@@ -100,24 +199,21 @@ def logout():
     session.clear()
     return redirect(url_for('login'))
 
-@app.route('/api/channels')
-def api_channels():
-    if not check_auth():
-        return jsonify({'error': 'Unauthorized'}), 401
-    
-    user_id = session['telegram_user_id']
-    
-    # Get user's own channels and whitelisted channels
-    conn = get_db()
+@cache.memoize(timeout=5)
+def get_user_channels(user_id):
+    """Get user's own channels and whitelisted channels"""
+    # Plain tuples instead of sqlite3.Row, unpacked positionally below
+    cursor = get_db().cursor()
+    cursor.row_factory = None
     
     # Own channels
-    own_channels = conn.execute(
+    own_channels = cursor.execute(
         "SELECT channel_id, channel_name, is_power_on, last_request_time FROM channels WHERE owner_id = ?",
         (user_id,)
     ).fetchall()
     
     # Whitelisted channels
-    whitelisted_channels = conn.execute(
+    whitelisted_channels = cursor.execute(
         """SELECT c.channel_id, c.channel_name, c.is_power_on, c.last_request_time 
            FROM channels c 
            JOIN whitelist w ON c.channel_id = w.channel_id 
@@ -125,17 +221,22 @@ def api_channels():
         (user_id,)
     ).fetchall()
     
-    conn.close()
-    
-    result = []
-    for ch in own_channels + whitelisted_channels:
-        result.append({
-            'id': ch['channel_id'],
-            'name': ch['channel_name'] or f"Channel {ch['channel_id']}",
-            'status': 'online' if ch['is_power_on'] else 'offline',
-            'last_ping': ch['last_request_time']
-        })
-    return jsonify(result)
+    return [
+        {
+            'id': channel_id,
+            'name': channel_name or f"Channel {channel_id}",
+            'status': 'online' if is_power_on else 'offline',
+            'last_ping': last_request_time
+        }
+        for channel_id, channel_name, is_power_on, last_request_time in own_channels + whitelisted_channels
+    ]
+
+@app.route('/api/channels')
+def api_channels():
+    if not check_auth():
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    return jsonify(get_user_channels(session['telegram_user_id']))
 
 @app.route('/api/stats/<channel_id>')
 def api_stats(channel_id):
@@ -149,24 +250,26 @@ def api_stats(channel_id):
     
     user_id = session['telegram_user_id']
     
-    # Check access
-    if not check_channel_access(user_id, channel_id):
-        return jsonify({'error': 'Access denied'}), 403
-    
-    # Parse range parameter
-    range_param = request.args.get('range', request.args.get('days', '7'))
-    
     conn = get_db()
     
-    # Get channel info
+    # Get channel info (including current status) along with whether the user is whitelisted for it
     channel = conn.execute(
-        "SELECT timezone FROM channels WHERE channel_id = ?", (channel_id,)
+        """SELECT owner_id, timezone, is_power_on,
+                  EXISTS(SELECT 1 FROM whitelist w WHERE w.channel_id = c.channel_id AND w.user_id = ?) AS whitelisted
+           FROM channels c
+           WHERE channel_id = ?""",
+        (user_id, channel_id)
     ).fetchone()
     
-    if not channel:
-        return jsonify({'error': 'Channel not found'}), 404
+    # Check access: user owns the channel or is whitelisted. Unknown channels are
+    # reported the same way so channel IDs can't be probed.
+    if not channel or (channel['owner_id'] != user_id and not channel['whitelisted']):
+        return jsonify({'error': 'Access denied'}), 403
     
-    tz = pytz.timezone(channel['timezone'])
+    # Parse range parameter
+    range_param = request.args.get('range', request.args.get('days', '7'))
+    
+    tz = get_timezone(channel['timezone'])
     now = datetime.now(tz)
     
     # Calculate start time and range_days based on range
@@ -197,155 +300,103 @@ def api_stats(channel_id):
         except ValueError:
             return jsonify({'error': 'Invalid range parameter'}), 400
     
-    # Get history
-    history = conn.execute(
-        "SELECT timestamp, status FROM history WHERE channel_id = ? AND timestamp >= ? ORDER BY timestamp",
-        (channel_id, start_time)
-    ).fetchall()
-    
     # Get status at start of time range (last event before start_time) to extend line backwards
     status_at_start = conn.execute(
         "SELECT status FROM history WHERE channel_id = ? AND timestamp < ? ORDER BY timestamp DESC LIMIT 1",
         (channel_id, start_time)
     ).fetchone()
     
-    # Get current status to extend timeline to now
-    current_channel = conn.execute(
-        "SELECT is_power_on FROM channels WHERE channel_id = ?", (channel_id,)
-    ).fetchone()
-    
-    # Get all history for status lookups (for daily stats calculation)
-    all_history = conn.execute(
-        "SELECT timestamp, status FROM history WHERE channel_id = ? ORDER BY timestamp",
-        (channel_id,)
+    # Format for charts: parallel lists of times (ms) and statuses instead of a dict per point
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    history = cursor.execute(
+        "SELECT timestamp, status FROM history WHERE channel_id = ? AND timestamp >= ? ORDER BY timestamp",
+        (channel_id, start_time)
     ).fetchall()
-    
-    conn.close()
-    
-    # Format for charts
-    timeline = []
-    
-    # Add starting point if we have status before the range (to show full line from start)
-    if status_at_start and history:
-        timeline.append({
-            'time': int(start_time * 1000),
-            'status': status_at_start['status']
-        })
-    
-    for h in history:
-        timeline.append({
-            'time': int(h['timestamp'] * 1000),
-            'status': h['status']
-        })
-    
-    # Add current status point at "now" to extend the line
-    if current_channel and timeline:
-        timeline.append({
-            'time': int(now.timestamp() * 1000),
-            'status': current_channel['is_power_on']
-        })
-    
-    # Calculate daily stats - use all_history to get complete days
-    daily_stats = {}
-    
-    # Generate ALL calendar days in the range
-    start_dt = datetime.fromtimestamp(start_time, tz).replace(hour=0, minute=0, second=0, microsecond=0)
-    days_in_range = set()
-    d = start_dt
-    while d.date() <= now.date():
-        days_in_range.add(d.strftime('%Y-%m-%d'))
-        d += timedelta(days=1)
-    
-    # Now get ALL events for those days (not just events in time range)
-    for h in all_history:
-        dt = datetime.fromtimestamp(h['timestamp'], tz)
-        day = dt.strftime('%Y-%m-%d')
-        if day in days_in_range:
-            if day not in daily_stats:
-                daily_stats[day] = {'events': []}
-            daily_stats[day]['events'].append({'time': h['timestamp'], 'status': h['status']})
-    
-    # Ensure all days in range exist in daily_stats (even with no events)
-    for day in days_in_range:
-        if day not in daily_stats:
-            daily_stats[day] = {'events': []}
-    
-    # Get status at start of each day for proper calculation
-    for day in list(daily_stats.keys()):
-        day_naive = datetime.strptime(day, '%Y-%m-%d')
-        day_date = tz.localize(day_naive)
-        day_start = day_date.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    times = [int(timestamp * 1000) for timestamp, _ in history]
+    statuses = [status for _, status in history]
+    
+    if history:
+        # Add starting point if we have status before the range (to show full line from start)
+        if status_at_start:
+            times.insert(0, int(start_time * 1000))
+            statuses.insert(0, status_at_start['status'])
         
-        # Find status at start of this day from all_history
-        status_at_day_start = None
-        for h in reversed(all_history):
-            if h['timestamp'] < day_start:
-                status_at_day_start = h['status']
-                break
-        
-        if status_at_day_start is not None:
-            daily_stats[day]['status_at_start'] = status_at_day_start
-        elif daily_stats[day]['events']:
-            # No history before this day, use first event's status
-            daily_stats[day]['status_at_start'] = daily_stats[day]['events'][0]['status']
-        else:
-            # No events and no history, use current status
-            daily_stats[day]['status_at_start'] = current_channel['is_power_on'] if current_channel else 0
-    
-    # Calculate uptime/downtime per day
-    for day, data in daily_stats.items():
-        events = sorted(data['events'], key=lambda x: x['time'])
-        uptime = downtime = 0
-        
-        # Properly localize the day start time
-        day_naive = datetime.strptime(day, '%Y-%m-%d')
-        day_date = tz.localize(day_naive)
-        day_start = day_date.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-        
-        # Start from midnight with status at that time
-        prev_status = data.get('status_at_start', 0)
-        prev_time = day_start
-        
-        for event in events:
-            duration = event['time'] - prev_time
-            if prev_status == 1:
-                uptime += duration
-            else:
-                downtime += duration
-            
-            prev_status = event['status']
-            prev_time = event['time']
-        
-        # Add period from last event (or day start if no events) to end of day (or now if today)
-        if day == now.strftime('%Y-%m-%d'):
-            # Today: add from last event to now
-            end_time = now.timestamp()
-        else:
-            # Past day: add from last event to end of day (midnight next day)
-            end_of_day = day_date + timedelta(days=1)
-            end_time = end_of_day.replace(hour=0, minute=0, second=0).timestamp()
-        
-        ongoing_duration = end_time - prev_time
-        if prev_status == 1:
-            uptime += ongoing_duration
-        else:
-            downtime += ongoing_duration
-        
-        data['uptime'] = uptime
-        data['downtime'] = downtime
-        del data['events']
-        if 'status_at_start' in data:
-            del data['status_at_start']
+        # Add current status point at "now" to extend the line
+        times.append(int(now.timestamp() * 1000))
+        statuses.append(channel['is_power_on'])
+    
+    timeline = {'t': times, 's': statuses}
+    
+    # Calculate daily stats
+    # Generate ALL calendar days in the range from their ordinals, formatting each day once
+    midnights = [
+        datetime.fromordinal(o)
+        for o in range(datetime.fromtimestamp(start_time, tz).toordinal(), now.toordinal() + 1)
+    ]
+    days = [midnight.date().isoformat() for midnight in midnights]
+    
+    # Local midnight of each day; today ends now
+    day_starts = [tz.localize(midnight).timestamp() for midnight in midnights]
+    day_ends = day_starts[1:] + [now.timestamp()]
+    
+    # Each day starts with a point carrying the status at midnight; every point
+    # lasts until the next point of the same day (or the end of the day)
+    daily_rows = conn.execute(
+        """WITH days AS (
+               SELECT json_extract(value, '$[0]') AS day,
+                      json_extract(value, '$[1]') AS day_start,
+                      json_extract(value, '$[2]') AS day_end
+               FROM json_each(:days)
+           ),
+           points AS (
+               -- Status at midnight: last event before it, else the day's first event, else current status
+               SELECT day, day_start AS timestamp, 0 AS is_event, day_end, COALESCE(
+                   (SELECT status FROM history
+                    WHERE channel_id = :channel_id AND timestamp < day_start
+                    ORDER BY timestamp DESC LIMIT 1),
+                   (SELECT status FROM history
+                    WHERE channel_id = :channel_id AND timestamp >= day_start AND timestamp < day_end
+                    ORDER BY timestamp LIMIT 1),
+                   :current_status
+               ) AS status
+               FROM days
+               UNION ALL
+               SELECT d.day, h.timestamp, 1, d.day_end, h.status
+               FROM days d
+               JOIN history h ON h.channel_id = :channel_id
+                   AND h.timestamp >= d.day_start AND h.timestamp < d.day_end
+           )
+           SELECT day,
+                  SUM(CASE WHEN status = 1 THEN duration ELSE 0 END) AS uptime,
+                  SUM(CASE WHEN status = 1 THEN 0 ELSE duration END) AS downtime
+           FROM (
+               SELECT day, status,
+                      COALESCE(LEAD(timestamp) OVER (PARTITION BY day ORDER BY timestamp, is_event), day_end)
+                          - timestamp AS duration
+               FROM points
+           )
+           GROUP BY day""",
+        {
+            'days': orjson.dumps(list(zip(days, day_starts, day_ends))).decode(),
+            'channel_id': channel_id,
+            'current_status': channel['is_power_on'],
+        }
+    ).fetchall()
+    
+    daily_stats = {
+        row['day']: {'uptime': row['uptime'], 'downtime': row['downtime']}
+        for row in daily_rows
+    }
     
     # Generate daily timeline for daily view (percentage per day)
     daily_timeline = []
     if request.args.get('daily') == 'true':
-        for day in sorted(daily_stats.keys()):
-            day_naive = datetime.strptime(day, '%Y-%m-%d')
-            day_date = tz.localize(day_naive)
-            day_start = day_date.replace(hour=12, minute=0, second=0, microsecond=0)  # Noon for display
+        # Past days use their real length (23h/25h on DST changes); today keeps a full-day denominator
+        day_lengths = [end - start for start, end in zip(day_starts, day_ends[:-1])] + [24 * 60 * 60]
+        for day, midnight, total_seconds in zip(days, midnights, day_lengths):
+            day_start = tz.localize(midnight.replace(hour=12))  # Noon for display
             
-            total_seconds = 24 * 60 * 60
             uptime_seconds = daily_stats[day]['uptime']
             percentage = (uptime_seconds / total_seconds) * 100
             
@@ -368,8 +419,8 @@ def api_stats(channel_id):
     if grouping == 'daily':
         grouped_stats = daily_stats
     elif grouping == 'weekly':
-        for day_str, data in daily_stats.items():
-            day_date = datetime.strptime(day_str, '%Y-%m-%d')
+        for day, day_date in zip(days, midnights):
+            data = daily_stats[day]
             monday = day_date - timedelta(days=day_date.weekday())
             sunday = monday + timedelta(days=6)
             sort_key = monday.strftime('%Y-%m-%d')
@@ -381,8 +432,8 @@ def api_stats(channel_id):
             grouped_stats[sort_key]['uptime'] += data['uptime']
             grouped_stats[sort_key]['downtime'] += data['downtime']
     else:  # monthly
-        for day_str, data in daily_stats.items():
-            day_date = datetime.strptime(day_str, '%Y-%m-%d')
+        for day, day_date in zip(days, midnights):
+            data = daily_stats[day]
             sort_key = day_date.strftime('%Y-%m')
             label = day_date.strftime('%b %Y')
             
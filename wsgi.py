@@ -0,0 +1,3 @@
+#!/usr/bin/env python3
+"""WSGI entry point for production servers, e.g. gunicorn wsgi:app"""
+from app import app